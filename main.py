@@ -1,10 +1,21 @@
-# main.py（S3指定時のみ {job_id}/logs/ にログ出力）
-import argparse, io, json, time, sys, traceback, datetime, os, platform
+# main.py（S3指定時のみ {job_id}/logs/ にログ出力。--key-layout flat なら logs/{job_id}/）
+import argparse, atexit, json, time, sys, tempfile, traceback, datetime, os, platform
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum
 from pathlib import Path
+import numpy as np
 import pandas as pd
 import gurobipy as gp
 from gurobipy import GRB
 
+# solve() は gurobipy の行列API（MVar の @ / addMConstr）を使う：gurobipy>=10.0 と scipy が必要
+if gp.gurobi.version()[0] < 10:
+    raise ImportError(f"gurobipy>=10.0 is required (found {'.'.join(map(str, gp.gurobi.version()))})")
+try:
+    import scipy.sparse  # noqa: F401  行列APIが内部で使用
+except ImportError as e:
+    raise ImportError("scipy is required by the gurobipy matrix API used in solve()") from e
+
 
 # GurobiStatusCode
 GRB_STATUS = {
@@ -26,10 +37,36 @@ GRB_STATUS = {
 }
 
 
+# S3 上のキー配置
+class S3KeyLayout(Enum):
+    NESTED = "nested"  # {job_id}/input/products.csv
+    FLAT   = "flat"    # input/{job_id}/products.csv
+
+    def _key(self, job_id: str, kind: str, name: str) -> str:
+        if self is S3KeyLayout.FLAT:
+            return f"{kind}/{job_id}/{name}"
+        return f"{job_id}/{kind}/{name}"
+
+    def products_key(self, job_id: str) -> str:
+        return self._key(job_id, "input", "products.csv")
+
+    def capacities_key(self, job_id: str) -> str:
+        return self._key(job_id, "input", "capacities.json")
+
+    def solution_key(self, job_id: str) -> str:
+        return self._key(job_id, "output", "solution.csv")
+
+    def log_key(self, job_id: str, name: str) -> str:
+        return self._key(job_id, "logs", name)
+
+
 def parse_args():
     ap = argparse.ArgumentParser()
     ap.add_argument("--job-id", required=True)
     ap.add_argument("--bucket")  # ある時だけS3を使う
+    ap.add_argument("--verbose", action="store_true")  # 解を全行表示（既定は先頭20行）
+    ap.add_argument("--key-layout", choices=[k.value for k in S3KeyLayout],
+                    default=S3KeyLayout.NESTED.value)  # S3 キー配置
     return ap.parse_args()
 
 def load_local_inputs():
@@ -41,97 +78,179 @@ def load_local_inputs():
     caps = json.loads(p_json.read_text(encoding="utf-8"))
     return df, caps
 
-def load_s3_inputs(bucket: str, job_id: str):
-    import boto3
-    s3 = boto3.client("s3")
-    prod_key = f"{job_id}/input/products.csv"
-    cap_key = f"{job_id}/input/capacities.json"
-    get = lambda k: s3.get_object(Bucket=bucket, Key=k)["Body"].read()
-    df   = pd.read_csv(io.BytesIO(get(prod_key)))
-    caps = json.loads(get(cap_key).decode("utf-8"))
+# S3 クライアントはプロセス内で1つだけ生成して使い回す
+_S3 = None
+
+def _s3():
+    global _S3
+    if _S3 is None:
+        import boto3
+        from botocore.config import Config
+        _S3 = boto3.client("s3", config=Config(max_pool_connections=16, tcp_keepalive=True))
+    return _S3
+
+_MB = 1024 * 1024
+_TRANSFER_CFG = None
+
+def _transfer_config():
+    """upload_file 用：8MB 超はマルチパートで並列アップロード"""
+    global _TRANSFER_CFG
+    if _TRANSFER_CFG is None:
+        from boto3.s3.transfer import TransferConfig
+        _TRANSFER_CFG = TransferConfig(multipart_threshold=8 * _MB, multipart_chunksize=8 * _MB,
+                                       max_concurrency=8, use_threads=True)
+    return _TRANSFER_CFG
+
+def load_s3_inputs(bucket: str, job_id: str, layout: S3KeyLayout = S3KeyLayout.NESTED):
+    s3 = _s3()
+    prod_key = layout.products_key(job_id)
+    cap_key = layout.capacities_key(job_id)
+    body = lambda k: s3.get_object(Bucket=bucket, Key=k)["Body"]
+    # 2 オブジェクトを並列に取得（StreamingBody はそのまま渡し、受信しながらパース）
+    with ThreadPoolExecutor(max_workers=2) as ex:
+        f_df   = ex.submit(lambda: pd.read_csv(body(prod_key)))
+        f_caps = ex.submit(lambda: json.loads(body(cap_key).read().decode("utf-8")))
+        df, caps = f_df.result(), f_caps.result()
     log("[info] loaded inputs from S3", {"bucket": bucket, "prod_key": prod_key, "cap_key": cap_key})
     return df, caps
 
-def write_s3_output(df: pd.DataFrame, bucket: str, job_id: str):
-    import boto3
-    s3 = boto3.client("s3")
-    key = f"{job_id}/output/solution.csv"
-    s3.put_object(Bucket=bucket, Key=key, Body=df.to_csv(index=False).encode("utf-8"))
+_SOL_DIR = "/tmp"
+
+def write_s3_output(df: pd.DataFrame, bucket: str, job_id: str, layout: S3KeyLayout = S3KeyLayout.NESTED):
+    s3 = _s3()
+    key = layout.solution_key(job_id)
+    # CSV 全体を str/bytes として持たず、ジョブ毎の一時ファイルに書き出してからアップロード
+    with tempfile.NamedTemporaryFile(dir=_SOL_DIR, prefix="solution_", suffix=".csv", delete=False) as f:
+        sol_path = f.name
+    try:
+        df.to_csv(sol_path, index=False, encoding="utf-8")
+        s3.upload_file(sol_path, bucket, key, Config=_transfer_config())
+    finally:
+        os.remove(sol_path)
     log("[info] wrote solution", {"s3_uri": f"s3://{bucket}/{key}"})
 
 # --- ロギング周り ------------------------------------------------------------
 _APP_LOG_PATH = "/tmp/app.log"
 _GRB_LOG_PATH = "/tmp/gurobi.log"
 
+# app.log は一度だけ開いて行バッファで追記（呼び出し毎の open/close を避けつつ、各行は即時に見える）
+_APP_LOG_FH = open(_APP_LOG_PATH, "a", buffering=1, encoding="utf-8")
+atexit.register(_APP_LOG_FH.close)
+
+# payload の JSON 化は orjson があればそちらを使う（C 実装で高速）
+# フォールバックも orjson と同じ区切り（空白なし）に揃え、環境によらずログ形式を一定にする
+try:
+    import orjson
+    def _dumps(o) -> str:
+        return orjson.dumps(o).decode("utf-8")
+except ImportError:
+    def _dumps(o) -> str:
+        return json.dumps(o, ensure_ascii=False, separators=(",", ":"))
+
+# 秒単位のタイムスタンプ文字列をキャッシュ（同一秒内は再生成しない）
+_last_ts_sec = 0
+_last_ts_str = ""
+
+def _ts() -> str:
+    global _last_ts_sec, _last_ts_str
+    s = int(time.time())
+    if s != _last_ts_sec:
+        _last_ts_sec = s
+        _last_ts_str = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(s))
+    return _last_ts_str
+
 def log(msg: str, payload: dict | None = None):
-    ts = datetime.datetime.utcnow().isoformat(timespec="seconds") + "Z"
+    ts = _ts()
     if payload:
-        print(f"{ts} {msg} {json.dumps(payload, ensure_ascii=False)}")
+        line = f"{ts} {msg} {_dumps(payload)}"
     else:
-        print(f"{ts} {msg}")
+        line = f"{ts} {msg}"
+    print(line)
     # 同時にファイルにも追記
-    with open(_APP_LOG_PATH, "a", encoding="utf-8") as f:
-        if payload:
-            f.write(f"{ts} {msg} {json.dumps(payload, ensure_ascii=False)}\n")
-        else:
-            f.write(f"{ts} {msg}\n")
+    _APP_LOG_FH.write(line + "\n")
+
+def log_offsets() -> dict:
+    """ジョブ開始時点の各ログファイルのサイズ（同一プロセスで複数ジョブを流す際、自ジョブ分だけを切り出す）"""
+    _APP_LOG_FH.flush()
+    return {p: (os.path.getsize(p) if Path(p).exists() else 0) for p in (_APP_LOG_PATH, _GRB_LOG_PATH)}
 
-def upload_logs_if_needed(use_s3: bool, bucket: str | None, job_id: str):
+def upload_logs_if_needed(use_s3: bool, bucket: str | None, job_id: str,
+                          layout: S3KeyLayout = S3KeyLayout.NESTED, offsets: dict | None = None):
     if not use_s3:
         return
-    import boto3, os
-    s3 = boto3.client("s3")
+    s3 = _s3()
+    offsets = offsets or {}
     ts = datetime.datetime.utcnow().strftime("%Y%m%dT%H%M%SZ")
-    app_key = f"{job_id}/logs/app_{ts}.log"
-    grb_key = f"{job_id}/logs/gurobi_{ts}.log"
-    # app.log
-    if Path(_APP_LOG_PATH).exists():
-        s3.upload_file(_APP_LOG_PATH, bucket, app_key)
-        print(f"[info] uploaded app log to s3://{bucket}/{app_key}")
-    # gurobi.log
-    if Path(_GRB_LOG_PATH).exists():
-        s3.upload_file(_GRB_LOG_PATH, bucket, grb_key)
-        print(f"[info] uploaded gurobi log to s3://{bucket}/{grb_key}")
+    app_key = layout.log_key(job_id, f"app_{ts}.log")
+    grb_key = layout.log_key(job_id, f"gurobi_{ts}.log")
+    # app.log（バッファ分を書き出してからアップロード）
+    _APP_LOG_FH.flush()
+    for path, key, name in ((_APP_LOG_PATH, app_key, "app"), (_GRB_LOG_PATH, grb_key, "gurobi")):
+        if not Path(path).exists():
+            continue
+        # ジョブ開始時のオフセット以降（このジョブ分）だけをアップロード
+        with open(path, "rb") as f:
+            f.seek(offsets.get(path, 0))
+            s3.upload_fileobj(f, bucket, key, Config=_transfer_config())
+        print(f"[info] uploaded {name} log to s3://{bucket}/{key}")
 
 
 # --- 起動時ログ（最小）＆ライセンスログ初期化 -------------------------------
+_PLATFORM = platform.platform()  # import 時に一度だけ取得
+
 def log_startup(job_id: str, use_s3: bool):
     py_ver = sys.version.split()[0]
     grb_py_ver = getattr(gp, "__version__", "unknown")
     log("[info] startup", {
         "job_id": job_id, "use_s3": use_s3,
-        "python": py_ver, "platform": platform.platform(),
+        "python": py_ver, "platform": _PLATFORM,
         "gurobipy": grb_py_ver
     })
 
+# ライセンス解決済みの Env を保持し、solve() のモデルでも使い回す
+_ENV = None
+
 def init_gurobi_logging():
     """最小：ライセンス解決を走らせつつ、ログファイルだけ確実に出させる"""
+    global _ENV
+    if _ENV is not None:
+        return
     try:
         env = gp.Env(empty=True)
         env.setParam("LogFile", _GRB_LOG_PATH)  # ライセンス情報含む全ログを /tmp/gurobi.log へ
         env.start()
-        env.dispose()
+        _ENV = env
         log("[info] gurobi log initialized", {"path": _GRB_LOG_PATH})
     except Exception as e:
         log("[warn] gurobi log init failed", {"error": str(e)})
 
 # --- 最適化 -------------------------------------------------------------------
 def solve(products: pd.DataFrame, caps: dict, enable_solver_log: bool):
-    m = gp.Model("pm")
+    b = np.array([float(caps.get("resA", np.inf)), float(caps.get("resB", np.inf))])
+    mask = np.isfinite(b)  # 容量指定のある資源のみ制約化
+
+    m = gp.Model("pm", env=_ENV)  # 初期化失敗時(None)は既定 Env
     # コンソール出力は抑えつつ、S3出力時のみファイルに Gurobi ログ保存
     m.Params.OutputFlag = 0
     if enable_solver_log:
         m.Params.LogFile = _GRB_LOG_PATH  # /tmp にログ生成（後でS3へアップ）
+    # 制約高々2本の小さな LP 向け：主単体法・1スレッドで並列起動のオーバーヘッドを避ける
+    m.Params.Method  = 0
+    m.Params.Threads = 1
+    if mask.any():
+        m.Params.Presolve = 0  # 資源制約がある（高々2行）なら Presolve は削るものがない
 
-    items  = products["product"].tolist()
-    profit = {r.product: float(r.profit) for r in products.itertuples()}
-    resA   = {r.product: float(r.resA)   for r in products.itertuples()}
-    resB   = {r.product: float(r.resB)   for r in products.itertuples()}
+    items = products["product"].tolist()
+    # 係数は (3, N) の列指向配列に一度だけ取り出す: [profit, resA, resB]
+    coef  = np.ascontiguousarray(products[["profit", "resA", "resB"]].to_numpy(dtype=np.float64).T)
+    prof  = coef[0]   # 目的係数（連続ビュー）
+    A     = coef[1:]  # 資源消費行列 (2, N)（連続ビュー）
 
-    x = m.addVars(items, lb=0.0, name="x")
-    m.setObjective(gp.quicksum(profit[i]*x[i] for i in items), GRB.MAXIMIZE)
-    if "resA" in caps: m.addConstr(gp.quicksum(resA[i]*x[i] for i in items) <= float(caps["resA"]))
-    if "resB" in caps: m.addConstr(gp.quicksum(resB[i]*x[i] for i in items) <= float(caps["resB"]))
+    # 行列APIで一括構築（quicksum の Python ループを避ける）
+    x = m.addMVar(len(items), lb=0.0, name="x")
+    m.setObjective(prof @ x, GRB.MAXIMIZE)
+    if mask.any():
+        m.addMConstr(A[mask], x, "<", b[mask])
 
     log("[info] start optimize", {"n_var": len(items), "caps": caps})
     m.optimize()
@@ -140,41 +259,50 @@ def solve(products: pd.DataFrame, caps: dict, enable_solver_log: bool):
     if m.status != GRB.OPTIMAL:
         raise RuntimeError(f"status={m.status}")
 
-    sol = pd.DataFrame([
-        {"product": i, "quantity": x[i].X, "profit_contrib": profit[i]*x[i].X}
-        for i in items
-    ])
+    qty = x.X  # 解を一括取得
+    sol = pd.DataFrame({"product": items, "quantity": qty, "profit_contrib": prof * qty})
     return m.ObjVal, sol
 
 # --- main --------------------------------------------------------------------
-def main():
-    a = parse_args()
-    use_s3 = bool((a.bucket or "").strip())
+_PREVIEW_ROWS = 20
+
+def run_job(job_id: str, bucket: str | None, verbose: bool = False,
+            layout: S3KeyLayout | str = S3KeyLayout.NESTED):
+    """1ジョブ分の処理。Env / S3 クライアント / ログハンドルはモジュール側で保持し、
+    同一プロセス内の後続ジョブでは再生成しない"""
+    use_s3 = bool((bucket or "").strip())
+    offsets = log_offsets()  # アップロードするログはこの位置以降（前のジョブ分を含めない）
+    key_layout = S3KeyLayout.NESTED  # 不正な layout 指定時のログ送り先
 
     # 起動ログ（簡素）
-    log_startup(a.job_id, use_s3)
-    init_gurobi_logging()
-    log("[info] job start", {"job_id": a.job_id, "use_s3": use_s3})
+    log_startup(job_id, use_s3)
+    init_gurobi_logging()  # 2回目以降は生成済みの Env を再利用
+    log("[info] job start", {"job_id": job_id, "use_s3": use_s3})
 
     try:
-        # デモ用の待機
-        log("[info] sleeping", {"seconds": 3600})
-        time.sleep(3600)
+        key_layout = S3KeyLayout(layout)
+
+        # デモ用の待機（DEMO_DELAY_SECONDS 指定時のみ、既定は待機なし）
+        delay = int(os.environ.get("DEMO_DELAY_SECONDS", "0"))
+        if delay > 0:
+            log("[info] sleeping", {"seconds": delay})
+            time.sleep(delay)
 
-        products, caps = load_s3_inputs(a.bucket, a.job_id) if use_s3 else load_local_inputs()
+        products, caps = load_s3_inputs(bucket, job_id, key_layout) if use_s3 else load_local_inputs()
         obj, sol = solve(products, caps, enable_solver_log=use_s3)
 
         log("[info] objective", {"value": float(obj)})
         log("[info] solution_preview", {"rows": len(sol)})
 
-        # 画面にも表示（開発用）
-        print(f"Objective={obj}")
-        print(sol.to_string(index=False))
+        # 画面にも表示（開発用）：既定は先頭のみ、まとめて1回で書き出す
+        shown = sol if verbose else sol.head(_PREVIEW_ROWS)
+        sys.stdout.write(f"Objective={obj}\n{shown.to_string(index=False)}\n")
 
         if use_s3:
-            write_s3_output(sol, a.bucket, a.job_id)
+            write_s3_output(sol, bucket, job_id, key_layout)
 
-        log("[info] job success", {"job_id": a.job_id})
+        log("[info] job success", {"job_id": job_id})
+        return obj
     except Exception as e:
         # 例外内容もログに残す
         tb = "".join(traceback.format_exception(type(e), e, e.__traceback__))
@@ -183,7 +311,17 @@ def main():
         raise
     finally:
         # S3 指定時のみログをアップロード
-        upload_logs_if_needed(use_s3, a.bucket, a.job_id)
+        upload_logs_if_needed(use_s3, bucket, job_id, key_layout, offsets)
+
+def handler(event: dict, context=None):
+    """常駐プロセス（Lambda 等）用エントリポイント: event = {"job_id": ..., "bucket": ..., "key_layout": ...}"""
+    obj = run_job(event["job_id"], event.get("bucket"), verbose=bool(event.get("verbose", False)),
+                  layout=event.get("key_layout", S3KeyLayout.NESTED.value))
+    return {"job_id": event["job_id"], "objective": float(obj)}
+
+def main():
+    a = parse_args()
+    run_job(a.job_id, a.bucket, verbose=a.verbose, layout=a.key_layout)
 
 if __name__ == "__main__":
     main()